@@ -1,12 +1,16 @@
 from fastapi import FastAPI, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse, PlainTextResponse
 import numpy as np
 import cv2
-from model_utils import run_inference_bgr
-from datetime import datetime
+from model_utils import run_inference_bgr, model_loaded
+import profiler
+from presence import PresenceTracker, DEFAULT_DEVICE_ID
 import io 
+import time
+from typing import Optional
 from PIL import Image
+from image_quality import assess_quality, QualityStats, RecapturePolicy, QUALITY_GATE_ENABLED, AUTO_RECAPTURE
 
 app = FastAPI()
 
@@ -15,6 +19,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Profile-Id"],
 )
 
 # ===========================
@@ -23,8 +28,120 @@ app.add_middleware(
 latest_result = None
 latest_image = None
 pending_command = None
-last_ping = None
-last_heartbeat = None
+device_commands = {}   # device_id -> (command, monotonic not-before time) for that device only
+presence = PresenceTracker()
+quality_stats = QualityStats()
+recapture_policy = RecapturePolicy()
+
+
+# ===========================
+# HELPERS
+# ===========================
+def device_id_of(request: Request) -> str:
+    """ESP devices identify themselves with X-Device-Id (or ?device_id=)."""
+    return (
+        request.headers.get("x-device-id")
+        or request.query_params.get("device_id")
+        or DEFAULT_DEVICE_ID
+    )
+
+
+def run_inference_timed(img_bgr, profile=None):
+    """
+    Run inference, tracing TensorFlow ops into the profile if there is one.
+    The duration feeds the quality gate's time-saved estimate, except for
+    cold starts (model load) and profiled requests, which would inflate it.
+    """
+    tf_trace_dir = profile["tf_trace_dir"] if profile else None
+    warm = model_loaded() and profile is None
+
+    started = time.perf_counter()
+    result = run_inference_bgr(img_bgr, tf_trace_dir=tf_trace_dir)
+    quality_stats.record_pass(time.perf_counter() - started if warm else None)
+    return result
+
+
+def queue_capture() -> bool:
+    """Queue a capture unless another command is already waiting."""
+    global pending_command
+    if pending_command is None:
+        pending_command = {"command": "capture"}
+        return True
+    return False
+
+
+def queue_device_capture(device_id: str) -> bool:
+    """
+    Queue a throttled capture that only device_id will receive from
+    /get-command, once its not-before time has passed. No attempt is used
+    up while a capture for the device is still waiting.
+    """
+    if device_id in device_commands:
+        return False
+    not_before = recapture_policy.schedule(device_id)
+    if not_before is None:
+        return False
+    device_commands[device_id] = ({"command": "capture"}, not_before)
+    return True
+
+
+def take_device_command(device_id: str):
+    """Pop the device's queued command if it is due, else None."""
+    queued = device_commands.get(device_id)
+    if queued is None or recapture_policy.clock() < queued[1]:
+        return None
+    device_commands.pop(device_id, None)
+    return queued[0]
+
+
+def reject_if_poor_quality(img_bgr, device_id=None):
+    """
+    Run the image-quality gate. Returns None if the frame may go to the
+    model, otherwise a 422 response describing why it was rejected.
+    If device_id is given, a throttled recapture may be queued for it.
+    """
+    if not QUALITY_GATE_ENABLED:
+        return None
+
+    quality = assess_quality(img_bgr)
+    if quality["ok"]:
+        if device_id is not None:
+            recapture_policy.record_ok(device_id)
+        return None
+
+    recapture_queued = (
+        device_id is not None
+        and AUTO_RECAPTURE
+        and queue_device_capture(device_id)
+    )
+    quality_stats.record_reject(quality["reason"], recapture_queued)
+    return JSONResponse(
+        status_code=422,
+        content={
+            "status": "rejected",
+            "reason": quality["reason"],
+            "detail": quality["detail"],
+            "quality": quality["metrics"],
+            "recapture_queued": recapture_queued,
+        },
+    )
+
+
+def ok_response(result, profile=None):
+    response = {"status": "ok", "result": result}
+    if profile:
+        response["profile_id"] = profile["id"]
+    return response
+
+
+def with_profile_id(response, profile):
+    """Tag every response of a profiled request (ok, rejected or error)."""
+    if profile is None:
+        return response
+    if not isinstance(response, Response):
+        response = JSONResponse(content=response)
+    response.headers["X-Profile-Id"] = profile["id"]
+    return response
 
 
 # ===========================
@@ -32,11 +149,16 @@ last_heartbeat = None
 # ===========================
 @app.post("/predict/raw")
 async def predict_raw(request: Request):
-    global latest_result, latest_image, last_ping
+    with profiler.maybe_profile(request.headers, "/predict/raw") as profile:
+        return with_profile_id(await _predict_raw(request, profile), profile)
+
+
+async def _predict_raw(request: Request, profile):
+    global latest_result, latest_image
 
     content = await request.body()
-    latest_image = content
-    last_ping = datetime.utcnow()
+    device_id = device_id_of(request)
+    presence.record_upload(device_id)
 
     try:
         # 1. Use io.BytesIO to treat the raw content as a file
@@ -53,11 +175,19 @@ async def predict_raw(request: Request):
         # Assuming it expects BGR for cv2 compatibility:
         img_bgr = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
 
-        # 5. Run inference using the BGR image
-        result = run_inference_bgr(img_bgr) # Pass the correctly formatted image
+        # 5. Reject blurry / badly exposed / leafless frames before the CNN
+        rejection = reject_if_poor_quality(img_bgr, device_id)
+        if rejection is not None:
+            return rejection
+
+        # 6. Run inference using the BGR image
+        result = run_inference_timed(img_bgr, profile)
+        # Image and result are updated together so the dashboard never
+        # pairs a rejected frame with an older frame's diagnosis.
+        latest_image = content
         latest_result = result
 
-        return {"status": "ok", "result": result}
+        return ok_response(result, profile)
         
     except Exception as e:
         # Use JSONResponse to return a clear 500 error instead of a generic crash
@@ -71,19 +201,38 @@ async def predict_raw(request: Request):
 # IMAGE UPLOAD (Manual UI)
 # ===========================
 @app.post("/predict")
-async def predict(file: UploadFile = File(...)):
+async def predict(request: Request, file: UploadFile = File(...)):
+    with profiler.maybe_profile(request.headers, "/predict") as profile:
+        try:
+            response = await _predict(file, profile)
+        except Exception as e:
+            if profile is None:
+                raise
+            print(f"CRITICAL ERROR in /predict: {e}")
+            response = JSONResponse(
+                status_code=500,
+                content={"status": "error", "message": f"Failed to process image: {str(e)}"}
+            )
+        return with_profile_id(response, profile)
+
+
+async def _predict(file: UploadFile, profile):
     global latest_result, latest_image
 
     content = await file.read()
-    latest_image = content
 
     nparr = np.frombuffer(content, np.uint8)
     img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
-    result = run_inference_bgr(img)
+    rejection = reject_if_poor_quality(img)
+    if rejection is not None:
+        return rejection
+
+    result = run_inference_timed(img, profile)
+    latest_image = content
     latest_result = result
 
-    return {"status": "ok", "result": result}
+    return ok_response(result, profile)
 
 
 # ===========================
@@ -101,6 +250,11 @@ def get_latest_image():
     return {"status": "no_image"}
 
 
+@app.get("/quality-stats")
+def get_quality_stats():
+    return quality_stats.snapshot()
+
+
 # ===========================
 # SPRAY CONTROL
 # ===========================
@@ -132,9 +286,7 @@ def spray_stop():
 # ===========================
 @app.post("/capture")
 def capture():
-    global pending_command
-    if pending_command is None:
-        pending_command = {"command": "capture"}
+    queue_capture()
     return {"status": "queued"}
 
 
@@ -142,8 +294,11 @@ def capture():
 # ESP COMMAND CHECK
 # ===========================
 @app.get("/get-command")
-def get_command():
+def get_command(request: Request):
     global pending_command
+    device_cmd = take_device_command(device_id_of(request))
+    if device_cmd:
+        return device_cmd
     if pending_command:
         cmd = pending_command
         pending_command = None
@@ -155,33 +310,23 @@ def get_command():
 # HEARTBEAT
 # ===========================
 @app.post("/esp-ping")
-def esp_ping():
-    global last_heartbeat
-    last_heartbeat = datetime.utcnow()
+def esp_ping(request: Request):
+    presence.record_heartbeat(device_id_of(request))
     return {"status": "ok"}
 
 
 @app.get("/esp-status")
-def esp_status():
-    global last_ping, last_heartbeat
-
-    if not last_ping and not last_heartbeat:
-        return {"status": "offline", "reason": "no data yet"}
-
-    now = datetime.utcnow()
-    ages = []
-
-    if last_ping:
-        ages.append((now - last_ping).total_seconds())
-    if last_heartbeat:
-        ages.append((now - last_heartbeat).total_seconds())
-
-    last_seen = min(ages)
+def esp_status(device_id: Optional[str] = None):
+    """
+    Status of one device; without device_id, the most recently seen one.
+    """
+    return presence.device_status(device_id)
 
-    if last_seen < 20:
-        return {"status": "online", "last_seen": last_seen}
 
-    return {"status": "offline", "last_seen": last_seen}
+@app.get("/fleet-status")
+def fleet_status(stale_limit: int = 100):
+    """Online/offline counts for every device plus the stale ones."""
+    return presence.fleet_status(stale_limit)
 
 
 # ===========================
@@ -189,10 +334,67 @@ def esp_status():
 # ===========================
 @app.post("/clear")
 def clear_state():
-    global latest_result, latest_image, pending_command, last_ping, last_heartbeat
+    global latest_result, latest_image, pending_command
     latest_result = None
     latest_image = None
     pending_command = None
-    last_ping = None
-    last_heartbeat = None
+    device_commands.clear()
+    presence.reset()
+    quality_stats.reset()
+    recapture_policy.reset()
+    return {"status": "cleared"}
+
+
+# ===========================
+# PROFILES (per-request profiling)
+# ===========================
+def admin_forbidden():
+    return JSONResponse(status_code=403, content={"status": "forbidden"})
+
+
+def profile_not_found():
+    return JSONResponse(status_code=404, content={"status": "not_found"})
+
+
+@app.get("/profiles")
+def get_profiles(request: Request):
+    if not profiler.is_admin(request.headers):
+        return admin_forbidden()
+    return {"profiles": profiler.list_profiles()}
+
+
+@app.get("/profiles/{profile_id}")
+def get_profile(profile_id: str, request: Request):
+    """Collapsed stacks, ready for flamegraph.pl / speedscope."""
+    if not profiler.is_admin(request.headers):
+        return admin_forbidden()
+    collapsed = profiler.get_collapsed(profile_id)
+    if collapsed is None:
+        return profile_not_found()
+    return PlainTextResponse(
+        collapsed,
+        headers={"Content-Disposition": f"attachment; filename={profile_id}.folded"},
+    )
+
+
+@app.get("/profiles/{profile_id}/tf-trace")
+def get_profile_tf_trace(profile_id: str, request: Request):
+    """TensorFlow profiler trace of model.predict, zipped for TensorBoard."""
+    if not profiler.is_admin(request.headers):
+        return admin_forbidden()
+    archive = profiler.get_tf_trace_zip(profile_id)
+    if archive is None:
+        return profile_not_found()
+    return Response(
+        archive,
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={profile_id}-tf-trace.zip"},
+    )
+
+
+@app.delete("/profiles")
+def delete_profiles(request: Request):
+    if not profiler.is_admin(request.headers):
+        return admin_forbidden()
+    profiler.clear_profiles()
     return {"status": "cleared"}
@@ -0,0 +1,93 @@
+# backend/evaluate_cascade.py
+"""
+Compare the two-stage cascade against the full model on a labelled sample.
+
+The sample directory holds one sub-folder per class label, e.g.
+
+    sample/Tomato___healthy/*.jpg
+    sample/Tomato___Early_blight/*.jpg
+
+Usage:
+    CASCADE_MODEL_PATH=healthy_gate.h5 python evaluate_cascade.py sample/ \\
+        --thresholds 0.8 0.9 0.95
+"""
+
+import os
+import time
+import argparse
+
+import cv2
+
+from model_utils import run_inference_bgr, load_cnn_model, load_cascade_model, CASCADE_THRESHOLD
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def load_sample(sample_dir, limit=None):
+    """Return [(label, bgr_image)] from a folder-per-class directory."""
+    sample = []
+    for label in sorted(os.listdir(sample_dir)):
+        class_dir = os.path.join(sample_dir, label)
+        if not os.path.isdir(class_dir):
+            continue
+        for name in sorted(os.listdir(class_dir)):
+            if not name.lower().endswith(IMAGE_EXTS):
+                continue
+            img = cv2.imread(os.path.join(class_dir, name), cv2.IMREAD_COLOR)
+            if img is not None:
+                sample.append((label, img))
+            if limit and len(sample) >= limit:
+                return sample
+    return sample
+
+
+def run_pass(sample, cascade_threshold):
+    """Run every image once; returns (labels predicted, stages, seconds)."""
+    started = time.perf_counter()
+    results = [run_inference_bgr(img, cascade_threshold=cascade_threshold) for _, img in sample]
+    elapsed = time.perf_counter() - started
+    return [r["label"] for r in results], [r["stage"] for r in results], elapsed
+
+
+def accuracy(predicted, sample):
+    return sum(p == label for p, (label, _) in zip(predicted, sample)) / len(sample)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sample_dir", help="folder with one sub-folder of images per class label")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[CASCADE_THRESHOLD],
+                        help="cascade confidence thresholds to evaluate")
+    parser.add_argument("--limit", type=int, default=None, help="use at most this many images")
+    args = parser.parse_args()
+
+    if load_cascade_model() is None:
+        parser.error("set CASCADE_MODEL_PATH to the first-stage model")
+
+    sample = load_sample(args.sample_dir, args.limit)
+    if not sample:
+        parser.error(f"no images found in {args.sample_dir}")
+
+    # Warm both models up so load time isn't counted as inference time
+    load_cnn_model()
+    run_inference_bgr(sample[0][1], cascade_threshold=None)
+    run_inference_bgr(sample[0][1], cascade_threshold=0.0)
+
+    full_labels, _, full_s = run_pass(sample, cascade_threshold=None)
+    print(f"Images: {len(sample)}")
+    print(f"Full model:  {len(sample) / full_s:7.2f} img/s  accuracy {accuracy(full_labels, sample):.2%}")
+    print()
+    print(f"{'threshold':>9}  {'img/s':>7}  {'speedup':>7}  {'early exit':>10}  {'agreement':>9}  {'accuracy':>8}")
+
+    for threshold in args.thresholds:
+        labels, stages, seconds = run_pass(sample, cascade_threshold=threshold)
+        early_exit = stages.count("cascade") / len(sample)
+        agreement = sum(a == b for a, b in zip(labels, full_labels)) / len(sample)
+        print(
+            f"{threshold:>9.2f}  {len(sample) / seconds:>7.2f}  {full_s / seconds:>6.2f}x  "
+            f"{early_exit:>10.1%}  {agreement:>9.2%}  {accuracy(labels, sample):>8.2%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# backend/image_quality.py
+
+import os
+import time
+import threading
+
+import cv2
+import numpy as np
+
+# =============================
+# CONFIG
+# =============================
+QUALITY_GATE_ENABLED = os.environ.get("QUALITY_GATE_ENABLED", "1") == "1"
+AUTO_RECAPTURE = os.environ.get("AUTO_RECAPTURE", "1") == "1"
+
+# Auto-recaptures are delayed per device (RECAPTURE_BACKOFF_S, doubling after
+# each attempt) and stop after MAX_AUTO_RECAPTURES recaptures without a good
+# frame, so a device facing a dark scene or blocked lens isn't kept in a loop.
+MAX_AUTO_RECAPTURES = int(os.environ.get("MAX_AUTO_RECAPTURES", "3"))
+RECAPTURE_BACKOFF_S = float(os.environ.get("RECAPTURE_BACKOFF_S", "5"))
+
+# All checks run on a frame downscaled so its longest side is this many pixels
+QUALITY_MAX_SIDE = int(os.environ.get("QUALITY_MAX_SIDE", "160"))
+
+MIN_BLUR_VARIANCE = float(os.environ.get("MIN_BLUR_VARIANCE", "60"))
+MAX_DARK_FRACTION = float(os.environ.get("MAX_DARK_FRACTION", "0.6"))
+MAX_BRIGHT_FRACTION = float(os.environ.get("MAX_BRIGHT_FRACTION", "0.4"))
+MIN_LEAF_COVERAGE = float(os.environ.get("MIN_LEAF_COVERAGE", "0.08"))
+
+DARK_LEVEL = 30       # gray level at or below which a pixel counts as dark
+BRIGHT_LEVEL = 235    # gray level at or above which a pixel counts as blown out
+
+# HSV range (OpenCV hue is 0–179) covering green to yellowish leaf tissue,
+# so chlorotic / diseased leaves still count as leaf.
+LEAF_HSV_LOW = np.array([20, 40, 30], dtype=np.uint8)
+LEAF_HSV_HIGH = np.array([95, 255, 255], dtype=np.uint8)
+
+# =============================
+# QUALITY CHECK
+# =============================
+
+def _downscale(np_bgr_image):
+    h, w = np_bgr_image.shape[:2]
+    scale = QUALITY_MAX_SIDE / max(h, w)
+    if scale >= 1:
+        return np_bgr_image
+    return cv2.resize(np_bgr_image, (max(1, int(w * scale)), max(1, int(h * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def assess_quality(np_bgr_image):
+    """
+    Cheap pre-check run before the CNN.
+    Returns: dict with ok flag, the first failing reason (or None) and metrics.
+    """
+    if np_bgr_image is None or np_bgr_image.size == 0:
+        return {"ok": False, "reason": "unreadable", "detail": "Image could not be decoded", "metrics": {}}
+
+    small = _downscale(np_bgr_image)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    # Blur: variance of the Laplacian (low = few edges = out of focus)
+    blur_variance = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+    # Exposure: share of pixels in the dark / blown-out ends of the histogram
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel() / gray.size
+    dark_fraction = float(hist[:DARK_LEVEL + 1].sum())
+    bright_fraction = float(hist[BRIGHT_LEVEL:].sum())
+
+    # Leaf coverage: share of pixels inside the leaf HSV range
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    leaf_coverage = float(np.count_nonzero(cv2.inRange(hsv, LEAF_HSV_LOW, LEAF_HSV_HIGH)) / gray.size)
+
+    metrics = {
+        "blur_variance": round(blur_variance, 2),
+        "dark_fraction": round(dark_fraction, 4),
+        "bright_fraction": round(bright_fraction, 4),
+        "leaf_coverage": round(leaf_coverage, 4),
+    }
+
+    # Exposure is checked first: a black or white frame also looks blurry
+    if dark_fraction > MAX_DARK_FRACTION:
+        reason, detail = "too_dark", f"{dark_fraction:.0%} of pixels are dark"
+    elif bright_fraction > MAX_BRIGHT_FRACTION:
+        reason, detail = "overexposed", f"{bright_fraction:.0%} of pixels are blown out"
+    elif blur_variance < MIN_BLUR_VARIANCE:
+        reason, detail = "blurry", f"Sharpness {blur_variance:.1f} is below {MIN_BLUR_VARIANCE}"
+    elif leaf_coverage < MIN_LEAF_COVERAGE:
+        reason, detail = "no_leaf", f"Leaf covers only {leaf_coverage:.0%} of the frame"
+    else:
+        reason, detail = None, None
+
+    return {"ok": reason is None, "reason": reason, "detail": detail, "metrics": metrics}
+
+# =============================
+# STATS
+# =============================
+
+class QualityStats:
+    """Counts rejections per reason and estimates the inference time saved."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.passed = 0
+            self.rejected = {}
+            self.unreadable = 0
+            self.recaptures_queued = 0
+            self._inference_count = 0
+            self._inference_total_s = 0.0
+
+    def record_pass(self, inference_s=None):
+        """
+        Count a frame that went to the model. inference_s is None when the
+        call shouldn't feed the average (cold start, profiled request).
+        """
+        with self._lock:
+            self.passed += 1
+            if inference_s is not None:
+                self._inference_count += 1
+                self._inference_total_s += inference_s
+
+    def record_reject(self, reason: str, recapture_queued: bool):
+        with self._lock:
+            # Undecodable frames could never have reached the model, so they
+            # are kept out of the rejection count and the time-saved estimate.
+            if reason == "unreadable":
+                self.unreadable += 1
+            else:
+                self.rejected[reason] = self.rejected.get(reason, 0) + 1
+            if recapture_queued:
+                self.recaptures_queued += 1
+
+    def snapshot(self):
+        with self._lock:
+            total_rejected = sum(self.rejected.values())
+            avg_inference_s = (
+                self._inference_total_s / self._inference_count if self._inference_count else None
+            )
+            saved_s = avg_inference_s * total_rejected if avg_inference_s is not None else None
+            return {
+                "enabled": QUALITY_GATE_ENABLED,
+                "passed": self.passed,
+                "rejected": total_rejected,
+                "rejected_by_reason": dict(self.rejected),
+                "unreadable": self.unreadable,
+                "recaptures_queued": self.recaptures_queued,
+                "avg_inference_ms": round(avg_inference_s * 1000, 2) if avg_inference_s is not None else None,
+                "inference_time_saved_ms": round(saved_s * 1000, 2) if saved_s is not None else None,
+            }
+
+
+# =============================
+# AUTO-RECAPTURE POLICY
+# =============================
+
+class RecapturePolicy:
+    """
+    Per-device throttle for automatic recaptures after a rejected frame.
+
+    Each recapture is scheduled with a not-before time: the first goes out
+    immediately, later ones wait backoff_s, then twice that, and so on.
+    After max_attempts recaptures without a good frame, auto-recapture
+    stops until the device sends a frame that passes the gate.
+    """
+
+    def __init__(self, max_attempts=MAX_AUTO_RECAPTURES, backoff_s=RECAPTURE_BACKOFF_S, clock=time.monotonic):
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._attempts = {}   # device -> recaptures since last good frame
+
+    def record_ok(self, device_id: str):
+        with self._lock:
+            self._attempts.pop(device_id, None)
+
+    def schedule(self, device_id: str):
+        """
+        Use up one recapture attempt for device_id.
+        Returns: monotonic not-before time for the capture, or None once
+        max_attempts is reached.
+        """
+        with self._lock:
+            attempts = self._attempts.get(device_id, 0)
+            if attempts >= self.max_attempts:
+                return None
+            self._attempts[device_id] = attempts + 1
+
+            delay = self.backoff_s * (2 ** (attempts - 1)) if attempts else 0.0
+            return self.clock() + delay
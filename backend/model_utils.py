@@ -12,6 +12,13 @@ import gdown
 MODEL_PATH = os.environ.get("MODEL_PATH", "plant_disease_model.h5")
 CSV_PATH = os.environ.get("CSV_PATH", "pesticide_data.csv")
 
+# Optional two-stage cascade: a small first-stage model answers confidently
+# healthy frames; everything else goes on to the full model.
+CASCADE_MODEL_PATH = os.environ.get("CASCADE_MODEL_PATH")
+CASCADE_THRESHOLD = float(os.environ.get("CASCADE_THRESHOLD", "0.9"))
+# For a 2-unit healthy/diseased softmax first stage: which unit is "healthy"
+CASCADE_HEALTHY_INDEX = int(os.environ.get("CASCADE_HEALTHY_INDEX", "0"))
+
 DRIVE_FILE_ID = "1xXCuUR-7yowBZLq_hGoVteGN_TLTRulG"  # <-- replace
 
 def download_model():
@@ -61,6 +68,40 @@ def load_cnn_model():
 
     return _model
 
+
+def model_loaded() -> bool:
+    """True once the CNN is in memory (so the next call is not a cold start)."""
+    return _model is not None
+
+
+_cascade_model = None
+
+def load_cascade_model():
+    """
+    Load the first-stage model exactly once.
+    Returns None when no CASCADE_MODEL_PATH is configured.
+    """
+    global _cascade_model
+
+    if _cascade_model is None and CASCADE_MODEL_PATH:
+        print("🚀 Loading cascade model...")
+        model = load_model(CASCADE_MODEL_PATH)
+
+        units = model.output_shape[-1]
+        if units not in (1, 2, len(classes)):
+            raise ValueError(
+                f"Cascade model {CASCADE_MODEL_PATH} has {units} outputs; expected 1 "
+                f"(sigmoid P(healthy)), 2 (healthy/diseased softmax) or {len(classes)} "
+                f"(softmax over the full model's classes)"
+            )
+        if units == 2 and CASCADE_HEALTHY_INDEX not in (0, 1):
+            raise ValueError(f"CASCADE_HEALTHY_INDEX must be 0 or 1, got {CASCADE_HEALTHY_INDEX}")
+
+        _cascade_model = model
+        print("✅ Cascade model loaded!")
+
+    return _cascade_model
+
 # =============================
 # LABEL CLEANING
 # =============================
@@ -137,15 +178,13 @@ def compute_final_dose(base_ml_per_L: float, infection_percent: float, water_vol
 # (Used by FastAPI /predict endpoint)
 # =============================
 
-def run_inference_bgr(np_bgr_image):
-    """
-    Accepts: numpy BGR image directly from ESP32 (OpenCV format)
-    Returns: dict with prediction + dose
-    """
+HEALTHY_LABEL = 'Tomato___healthy'
 
+
+def preprocess_bgr(np_bgr_image, model):
+    """Resize + scale a BGR image into a batch of one for the given model."""
     import cv2
 
-    model = load_cnn_model()
     input_shape = model.input_shape
     img_h = input_shape[1]
     img_w = input_shape[2]
@@ -154,14 +193,24 @@ def run_inference_bgr(np_bgr_image):
     img_rgb = cv2.cvtColor(np_bgr_image, cv2.COLOR_BGR2RGB)
     img_resized = cv2.resize(img_rgb, (img_w, img_h))
     img_resized = img_resized.astype(np.float32) / 255.0
-    img_resized = np.expand_dims(img_resized, axis=0)
+    return np.expand_dims(img_resized, axis=0)
+
+
+def healthy_probability(stage1_pred) -> float:
+    """
+    First-stage output is one of (checked in load_cascade_model):
+    - 1 unit: sigmoid P(healthy)
+    - 2 units: healthy/diseased softmax, healthy at CASCADE_HEALTHY_INDEX
+    - len(classes) units: softmax over the same classes as the full model
+    """
+    if len(stage1_pred) == 1:
+        return float(stage1_pred[0])
+    if len(stage1_pred) == 2:
+        return float(stage1_pred[CASCADE_HEALTHY_INDEX])
+    return float(stage1_pred[classes.index(HEALTHY_LABEL)])
 
-    # Prediction
-    pred = model.predict(img_resized)[0]
-    idx = int(np.argmax(pred))
-    confidence = float(pred[idx])
 
-    label = classes[idx]
+def build_result(label: str, confidence: float, pred, stage: str, stage1_pred=None):
     plant, disease = extract_plant_and_disease(label)
 
     infection_percent = confidence_to_infection(confidence)
@@ -182,5 +231,71 @@ def run_inference_bgr(np_bgr_image):
         "pesticide": pesticide,
         "base_ml_per_L": base_ml_per_L,
         "dose_ml": dose_ml,
-        "raw_pred": pred.tolist()
+        # Full-model class vector (indexed by `classes`); None when the
+        # cascade answered without running the full model.
+        "raw_pred": pred.tolist() if pred is not None else None,
+        "stage1_pred": stage1_pred.tolist() if stage1_pred is not None else None,
+        "stage": stage,
     }
+
+
+def predict(model, batch, tf_trace_dir=None):
+    """
+    model.predict, optionally traced with the TensorFlow profiler.
+    Tracing is a debug aid: if the profiler can't start (already active,
+    plugin missing), log it and predict untraced.
+    """
+    if tf_trace_dir is None:
+        return model.predict(batch)
+
+    import tensorflow as tf
+
+    try:
+        tf.profiler.experimental.start(tf_trace_dir)
+    except Exception as e:
+        print(f"⚠️ TF profiler unavailable, running untraced: {e}")
+        return model.predict(batch)
+
+    try:
+        return model.predict(batch)
+    finally:
+        try:
+            tf.profiler.experimental.stop()
+        except Exception as e:
+            print(f"⚠️ TF profiler failed to stop: {e}")
+
+
+def _stage_trace_dir(tf_trace_dir, stage: str):
+    return os.path.join(tf_trace_dir, stage) if tf_trace_dir else None
+
+
+def run_inference_bgr(np_bgr_image, tf_trace_dir=None, cascade_threshold=CASCADE_THRESHOLD):
+    """
+    Accepts: numpy BGR image directly from ESP32 (OpenCV format)
+    Returns: dict with prediction + dose
+
+    If CASCADE_MODEL_PATH is set, frames the first-stage model rates healthy
+    with probability >= cascade_threshold skip the full model
+    (result["stage"] == "cascade"). Pass cascade_threshold=None to always
+    run the full model.
+
+    If tf_trace_dir is given, each model.predict call is traced with the
+    TensorFlow profiler into tf_trace_dir/stage1 and tf_trace_dir/full
+    (viewable in TensorBoard). Separate directories keep the two runs from
+    overwriting each other, since TF names runs by the second.
+    """
+    # Stage 1: cheap healthy/diseased gate (only if a cascade model is set)
+    stage1_pred = None
+    cascade_model = load_cascade_model() if cascade_threshold is not None else None
+    if cascade_model is not None:
+        batch = preprocess_bgr(np_bgr_image, cascade_model)
+        stage1_pred = predict(cascade_model, batch, _stage_trace_dir(tf_trace_dir, "stage1"))[0]
+        p_healthy = healthy_probability(stage1_pred)
+        if p_healthy >= cascade_threshold:
+            return build_result(HEALTHY_LABEL, p_healthy, None, stage="cascade", stage1_pred=stage1_pred)
+
+    # Stage 2: full classifier
+    model = load_cnn_model()
+    pred = predict(model, preprocess_bgr(np_bgr_image, model), _stage_trace_dir(tf_trace_dir, "full"))[0]
+    idx = int(np.argmax(pred))
+    return build_result(classes[idx], float(pred[idx]), pred, stage="full", stage1_pred=stage1_pred)
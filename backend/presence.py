@@ -0,0 +1,163 @@
+# backend/presence.py
+
+import os
+import time
+import heapq
+import threading
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
+
+# =============================
+# CONFIG
+# =============================
+ONLINE_TIMEOUT_S = float(os.environ.get("ONLINE_TIMEOUT_S", "20"))
+EXPIRY_BUCKET_S = float(os.environ.get("EXPIRY_BUCKET_S", "1"))
+DEFAULT_DEVICE_ID = os.environ.get("DEFAULT_DEVICE_ID", "esp32")
+MAX_TRANSITIONS = 200
+
+# =============================
+# PRESENCE TRACKER
+# =============================
+
+class PresenceTracker:
+    """
+    Online/offline tracking for many devices.
+
+    Every heartbeat or upload moves the device into the expiry bucket that
+    covers (now + timeout). Buckets are drained in order from a heap, so
+    expiring devices costs time proportional to the devices that actually
+    expire, never to the fleet size. Online/offline counts are kept
+    incrementally. Devices may go offline up to one bucket width late.
+
+    Uses a monotonic clock, so wall-clock jumps don't flip device state.
+    """
+
+    def __init__(self, timeout_s=ONLINE_TIMEOUT_S, bucket_s=EXPIRY_BUCKET_S, clock=time.monotonic):
+        self.timeout_s = timeout_s
+        self.bucket_s = bucket_s
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._last_heartbeat = {}
+            self._last_upload = {}
+            self._last_seen = {}
+            self._device_bucket = {}
+            self._buckets = {}
+            self._bucket_heap = []
+            self._online = set()
+            # device -> monotonic time it went offline, in expiry order
+            self._offline = OrderedDict()
+            self._latest_device = None
+            self.transitions = deque(maxlen=MAX_TRANSITIONS)
+
+    # ---------- recording ----------
+
+    def record_heartbeat(self, device_id: str):
+        self._touch(device_id, "_last_heartbeat")
+
+    def record_upload(self, device_id: str):
+        self._touch(device_id, "_last_upload")
+
+    def _touch(self, device_id, table_name):
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+
+            getattr(self, table_name)[device_id] = now
+            self._last_seen[device_id] = now
+            self._latest_device = device_id
+
+            old_bucket = self._device_bucket.get(device_id)
+            if old_bucket is not None:
+                self._buckets[old_bucket].discard(device_id)
+
+            bucket = int((now + self.timeout_s) // self.bucket_s)
+            if bucket not in self._buckets:
+                self._buckets[bucket] = set()
+                heapq.heappush(self._bucket_heap, bucket)
+            self._buckets[bucket].add(device_id)
+            self._device_bucket[device_id] = bucket
+
+            if device_id not in self._online:
+                self._offline.pop(device_id, None)
+                self._online.add(device_id)
+                self._transition(device_id, "online", now, now)
+
+    # ---------- expiry ----------
+
+    def _expire(self, now):
+        """
+        Drain every bucket whose whole time range has passed. Devices are
+        stamped with the bucket's expiry time, not the time of this call.
+        """
+        while self._bucket_heap and (self._bucket_heap[0] + 1) * self.bucket_s <= now:
+            bucket = heapq.heappop(self._bucket_heap)
+            expired_at = (bucket + 1) * self.bucket_s
+            devices = self._buckets.pop(bucket)
+            for device_id in sorted(devices, key=lambda d: (self._last_seen[d], d)):
+                del self._device_bucket[device_id]
+                self._online.discard(device_id)
+                self._offline[device_id] = expired_at
+                self._transition(device_id, "offline", expired_at, now)
+
+    def _transition(self, device_id, state, at, now):
+        """Record a transition; at/now are monotonic, mapped to wall-clock."""
+        self.transitions.append({
+            "device_id": device_id,
+            "status": state,
+            "at": (datetime.utcnow() - timedelta(seconds=now - at)).isoformat(),
+        })
+
+    # ---------- queries ----------
+
+    def device_status(self, device_id=None):
+        """Status of one device (default: the most recently seen one)."""
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+
+            device_id = device_id or self._latest_device
+            if device_id is None or device_id not in self._last_seen:
+                return {"status": "offline", "reason": "no data yet"}
+
+            response = {
+                "device_id": device_id,
+                "status": "online" if device_id in self._online else "offline",
+                "last_seen": now - self._last_seen[device_id],
+            }
+            if device_id in self._last_heartbeat:
+                response["last_heartbeat"] = now - self._last_heartbeat[device_id]
+            if device_id in self._last_upload:
+                response["last_upload"] = now - self._last_upload[device_id]
+            return response
+
+    def fleet_status(self, stale_limit=100):
+        """
+        Aggregate counts plus up to stale_limit offline devices,
+        longest offline first.
+        """
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+
+            stale = []
+            for device_id, offline_since in self._offline.items():
+                if len(stale) >= stale_limit:
+                    break
+                stale.append({
+                    "device_id": device_id,
+                    "last_seen": now - self._last_seen[device_id],
+                    "offline_for": now - offline_since,
+                })
+
+            return {
+                "total": len(self._online) + len(self._offline),
+                "online": len(self._online),
+                "offline": len(self._offline),
+                "timeout_s": self.timeout_s,
+                "stale_devices": stale,
+                "recent_transitions": list(self.transitions)[-20:],
+            }
@@ -0,0 +1,182 @@
+# backend/profiler.py
+
+import io
+import os
+import hmac
+import sys
+import time
+import uuid
+import shutil
+import zipfile
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+# =============================
+# CONFIG
+# =============================
+# Profiling is opt-in: either every request (env var) or a single request
+# carrying the admin token in the X-Profile header.
+PROFILE_ALL_REQUESTS = os.environ.get("PROFILE_ALL_REQUESTS", "0") == "1"
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+SAMPLE_INTERVAL_S = float(os.environ.get("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000.0
+MAX_PROFILES = int(os.environ.get("PROFILE_MAX_STORED", "20"))
+
+PROFILE_HEADER = "x-profile"
+ADMIN_HEADER = "x-admin-token"
+
+# =============================
+# GATING
+# =============================
+
+def _token_matches(value) -> bool:
+    """Constant-time comparison against ADMIN_TOKEN (False if unset)."""
+    if ADMIN_TOKEN is None or value is None:
+        return False
+    return hmac.compare_digest(value.encode(), ADMIN_TOKEN.encode())
+
+
+def should_profile(headers) -> bool:
+    """True if this request asked (and is allowed) to be profiled."""
+    if PROFILE_ALL_REQUESTS:
+        return True
+    return _token_matches(headers.get(PROFILE_HEADER))
+
+
+def is_admin(headers) -> bool:
+    """Admin endpoints stay closed unless ADMIN_TOKEN is configured and sent."""
+    return _token_matches(headers.get(ADMIN_HEADER))
+
+# =============================
+# SAMPLING PROFILER
+# =============================
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _StackSampler(threading.Thread):
+    """
+    Samples the Python stack of one thread at a fixed interval and counts
+    collapsed stacks ('root;child;leaf'), the input format of flamegraph.pl
+    and speedscope.
+    """
+
+    def __init__(self, thread_id: int, interval_s: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+# =============================
+# STORAGE (last MAX_PROFILES kept in memory)
+# =============================
+_profiles = OrderedDict()
+_lock = threading.Lock()
+
+
+def _store(profile: dict):
+    with _lock:
+        _profiles[profile["id"]] = profile
+        while len(_profiles) > MAX_PROFILES:
+            _, evicted = _profiles.popitem(last=False)
+            shutil.rmtree(evicted["tf_trace_dir"], ignore_errors=True)
+
+
+def list_profiles():
+    with _lock:
+        return [
+            {k: v for k, v in p.items() if k not in ("stacks", "tf_trace_dir")}
+            for p in _profiles.values()
+        ]
+
+
+def get_collapsed(profile_id: str):
+    """Return the profile as collapsed-stack text, or None if unknown."""
+    with _lock:
+        profile = _profiles.get(profile_id)
+    if profile is None:
+        return None
+    return "\n".join(f"{stack} {count}" for stack, count in profile["stacks"].items()) + "\n"
+
+
+def get_tf_trace_zip(profile_id: str):
+    """Return the TensorFlow trace directory zipped in memory, or None."""
+    with _lock:
+        profile = _profiles.get(profile_id)
+    if profile is None or not os.path.isdir(profile["tf_trace_dir"]):
+        return None
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for root, _, files in os.walk(profile["tf_trace_dir"]):
+            for name in files:
+                path = os.path.join(root, name)
+                zf.write(path, os.path.relpath(path, profile["tf_trace_dir"]))
+    return buf.getvalue()
+
+
+def clear_profiles():
+    with _lock:
+        for p in _profiles.values():
+            shutil.rmtree(p["tf_trace_dir"], ignore_errors=True)
+        _profiles.clear()
+
+# =============================
+# REQUEST PROFILING
+# =============================
+
+@contextmanager
+def profile_request(endpoint: str):
+    """
+    Profile the current thread for the duration of the block.
+    Yields {"id", "tf_trace_dir"}; pass tf_trace_dir to
+    run_inference_bgr to also capture TensorFlow op timing.
+    """
+    profile_id = uuid.uuid4().hex[:12]
+    tf_trace_dir = os.path.join(PROFILE_DIR, profile_id)
+
+    sampler = _StackSampler(threading.get_ident(), SAMPLE_INTERVAL_S)
+    started = time.perf_counter()
+    sampler.start()
+    try:
+        yield {"id": profile_id, "tf_trace_dir": tf_trace_dir}
+    finally:
+        sampler.stop()
+        _store({
+            "id": profile_id,
+            "endpoint": endpoint,
+            "created_at": datetime.utcnow().isoformat(),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            "samples": sum(sampler.stacks.values()),
+            "stacks": sampler.stacks,
+            "tf_trace_dir": tf_trace_dir,
+        })
+
+
+@contextmanager
+def maybe_profile(headers, endpoint: str):
+    """profile_request if this request opted in, otherwise yields None."""
+    if not should_profile(headers):
+        yield None
+        return
+    with profile_request(endpoint) as profile:
+        yield profile